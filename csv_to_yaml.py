@@ -1,11 +1,13 @@
 """Script that generates a YAML file from a CSV file for use with user_creation.py"""
 import argparse
 import csv
+import io
 
-import yaml
+# Manufacturers user_creation.py accepts in a machine's 'manufacturer' subfield
+MANUFACTURERS = ("dell", "hp", "generic")
 
 
-def csv_to_yaml(csv_file, yaml_file, new_user, new_password):
+def csv_to_yaml(csv_file, yaml_file, new_user, new_password, manufacturer=None):
     """Converts csv to yaml
 
     Args:
@@ -13,24 +15,44 @@ def csv_to_yaml(csv_file, yaml_file, new_user, new_password):
         yaml_file (string): path to YAML file
         new_user (string): username for new account
         new_password (string): password for new account
+        manufacturer (string): manufacturer of every BMC, if known
     """
-    data = {}
+    # yaml is imported here rather than at the top so that --help is fast
+    import yaml
+
+    try:
+        # libyaml's C emitter is much faster than PyYAML's pure-Python one
+        from yaml import CSafeDumper as SafeDumper
+    except ImportError:
+        from yaml import SafeDumper
+
+    # The new account is the same for every machine
+    common = {"new_user": new_user, "new_password": new_password}
+    if manufacturer:
+        common["manufacturer"] = manufacturer
 
-    with open(csv_file, "r", encoding="utf-8") as csvfile:
-        csvreader = csv.reader(csvfile)
-        for row in csvreader:
-            ip_address = row[0]
-            admin_user = row[1]
-            admin_password = row[2]
-            data[ip_address] = {
-                "admin_user": admin_user,
-                "admin_password": admin_password,
-                "new_user": new_user,
-                "new_password": new_password,
-            }
+    # Read and decode the whole file in one go, rather than a small chunk at a
+    # time, and let the csv module split the lines in memory
+    with open(csv_file, "r", encoding="utf-8", newline="") as csvfile:
+        csv_text = csvfile.read()
+    csvreader = csv.reader(io.StringIO(csv_text, newline=""))
+    data = {}
+    for row_number, row in enumerate(csvreader, start=1):
+        machine = {"admin_user": row[1], "admin_password": row[2], **common}
+        # An optional fourth column gives the manufacturer of that BMC
+        if len(row) > 3 and row[3].strip():
+            row_manufacturer = row[3].strip().casefold()
+            if row_manufacturer not in MANUFACTURERS:
+                raise ValueError(
+                    f"Row {row_number} of {csv_file} has manufacturer "
+                    f"{row[3]!r}, which should be one of "
+                    f"{', '.join(repr(name) for name in MANUFACTURERS)}"
+                )
+            machine["manufacturer"] = row_manufacturer
+        data[row[0]] = machine
 
-    with open(yaml_file, "w", encoding="utf-8") as yamlfile:
-        yaml.dump(data, yamlfile, default_flow_style=False)
+    with open(yaml_file, "w", encoding="utf-8", buffering=1 << 20) as yamlfile:
+        yaml.dump(data, yamlfile, Dumper=SafeDumper, default_flow_style=False)
 
 
 if __name__ == "__main__":
@@ -63,6 +85,12 @@ if __name__ == "__main__":
         help="new user password",
         required=True,
     )
+    parser.add_argument(
+        "-m",
+        "--manufacturer",
+        choices=MANUFACTURERS,
+        help="manufacturer of every BMC, to skip discovery in user_creation.py",
+    )
     args = parser.parse_args()
 
-    csv_to_yaml(args.csv, args.yaml, args.user, args.password)
+    csv_to_yaml(args.csv, args.yaml, args.user, args.password, args.manufacturer)
@@ -1,23 +1,101 @@
 """Module that creates read-only BMC accounts"""
 import argparse
+import base64
+import functools
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
 
-import redfish
-import urllib3
-import yaml
+# redfish, requests, urllib3 and yaml take a noticeable time to import, so they
+# are imported by the functions that use them rather than here. That keeps
+# --help and argument errors fast.
 
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+# Default upper bound on the number of BMCs provisioned at the same time
+MAX_CONCURRENT_HOSTS = 32
+# Upper bound on the number of account lookups sent to a single BMC at once
+MAX_CONCURRENT_ACCOUNT_REQUESTS = 8
+
+# Where the results of Redfish discovery are remembered between runs, and for
+# how long (in seconds) a remembered result is trusted
+DISCOVERY_CACHE_PATH = os.path.join(
+    os.path.expanduser("~"), ".cache", "bmc_user_creation", "discovery.json"
+)
+DISCOVERY_CACHE_TTL = 30 * 24 * 60 * 60
+
+# How many times a Redfish call is attempted before giving up, and the delay (in
+# seconds) before the first retry. The delay doubles after every attempt.
+RETRY_ATTEMPTS = 4
+RETRY_BASE_DELAY = 0.5
+# Seconds to wait for a BMC to accept a connection, and for it to answer a
+# request. Account changes are given a little longer to finish.
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 10
+ACCOUNT_TIMEOUT = (CONNECT_TIMEOUT, 20)
+# HTTP statuses a BMC uses to ask the client to come back later, and the longest
+# delay (in seconds) its Retry-After header is honored up to
+RETRY_STATUSES = frozenset((429, 503))
+MAX_RETRY_AFTER = 30
+
+# Subfields every machine in the credential YAML file must have, in the order
+# they are kept in a credential tuple
+CREDENTIAL_KEYS = ("admin_user", "admin_password", "new_user", "new_password")
+REQUIRED_KEYS = frozenset(CREDENTIAL_KEYS)
+
+# Redfish resources used on every machine
+SYSTEMS_URL = "/redfish/v1/Systems"
+ROLES_URL = "/redfish/v1/AccountService/Roles"
+ACCOUNTS_URL = "/redfish/v1/AccountService/Accounts"
+# Dell keeps its accounts in fixed slots under the iDRAC manager
+IDRAC_ACCOUNTS_URL = "/redfish/v1/Managers/iDRAC.Embedded.1/Accounts"
+
+# The URL of the first member of a collection whose members are plain links,
+# read straight from the response bytes
+FIRST_MEMBER_RE = re.compile(
+    rb'"Members"\s*:\s*\[\s*\{\s*"@odata\.id"\s*:\s*"([^"\\]+)"'
+)
+
+# Redfish messages (without their registry and version) that report success,
+# even when a BMC puts them in an "error" object
+SUCCESS_MESSAGES = frozenset(("Success", "Created", "AccountModified"))
+
+# Manufacturers that can be given in a machine's optional 'manufacturer'
+# subfield to skip discovery, and the URL of their BMC's manager
+HINTED_MANAGER_URLS = {
+    "hp": "/redfish/v1/Managers/1",
+    "dell": "/redfish/v1/Managers/iDRAC.Embedded.1",
+    "generic": None,
+}
+
+# Vendors with manufacturer specific account handling, found by name in the
+# manufacturer reported by the machine. Anything else is "generic".
+VENDORS = ("hp", "dell")
+
+
+class ProvisioningError(Exception):
+    """Raised when an account can't be created or modified on a machine"""
 
 
 def main():
     """Main function"""
     # Get the command line arguments from the user.
     parser = argparse.ArgumentParser(description="Create new BMC Users")
-    parser.add_argument(
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument(
         "-i",
         "--info",
         metavar="info",
         help="path to credential YAML file",
-        required=True,
+    )
+    source.add_argument(
+        "--stdin-yaml",
+        action="store_true",
+        help="read credential YAML documents from stdin, one batch per document",
     )
     parser.add_argument(
         "-m",
@@ -25,150 +103,828 @@ def main():
         action="store_true",
         help="Use this flag to modify account password",
     )
+    parser.add_argument(
+        "-p",
+        "--parallelism",
+        metavar="parallelism",
+        type=positive_int,
+        default=MAX_CONCURRENT_HOSTS,
+        help=(
+            "number of BMCs to work on at the same time "
+            f"(default: {MAX_CONCURRENT_HOSTS})"
+        ),
+    )
+    parser.add_argument(
+        "-a",
+        "--auth",
+        choices=("basic", "session"),
+        default="basic",
+        help="Redfish authentication method (default: basic)",
+    )
+    parser.add_argument(
+        "--refresh-discovery",
+        action="store_true",
+        help="Discover every machine again instead of using the discovery cache",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Always parse the credential YAML instead of using its cached copy",
+    )
     args = parser.parse_args()
-    with open(args.info, "r", encoding="utf-8") as info_path:
-        info_dict = yaml.safe_load(info_path)
+    discovery_cache = load_discovery_cache()
+    if not args.stdin_yaml:
+        info_dict = load_info(args.info, use_cache=not args.no_cache)
+        run_batch(info_dict, discovery_cache, args)
+        return
 
-    for machine in info_dict:
-        key_list = list(info_dict[machine].keys())
-        if (
-            "admin_user" not in key_list
-            or "admin_password" not in key_list
-            or "new_user" not in key_list
-            or "new_password" not in key_list
-        ):
+    # A bad batch is reported and skipped so the batches after it still run
+    for batch_number, document in enumerate(read_stdin_documents(), start=1):
+        try:
+            info_dict = parse_batch(document)
+            if info_dict:
+                run_batch(info_dict, discovery_cache, args)
+        except ValueError as error:
+            print(f"FAILED: Skipped batch {batch_number} from stdin: {error}")
+            sys.stdout.flush()
+
+
+def positive_int(value):
+    """Parse a command line argument that must be a positive whole number
+
+    Args:
+        value (string): Argument given on the command line
+
+    Returns:
+        int: The parsed argument
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"{value!r} is not a positive integer")
+    return number
+
+
+def run_batch(info_dict, discovery_cache, args):
+    """Provision one credential YAML and print the result of every machine
+
+    Args:
+        info_dict (dict): Contains root and new account information
+        discovery_cache (dict): Discovery results keyed by IP of machine
+        args (argparse.Namespace): Command line arguments
+    """
+    try:
+        results = provision(
+            info_dict,
+            discovery_cache,
+            modify=args.modify,
+            auth=args.auth,
+            parallelism=args.parallelism,
+            refresh_discovery=args.refresh_discovery,
+        )
+        for _, _, message in results:
+            print(message)
+        # A supervisor reading a pipe should see the results of each batch
+        # as soon as it is done
+        sys.stdout.flush()
+    finally:
+        save_discovery_cache(discovery_cache)
+
+
+def provision(
+    info_dict,
+    discovery_cache,
+    modify=False,
+    auth="basic",
+    parallelism=MAX_CONCURRENT_HOSTS,
+    refresh_discovery=False,
+):
+    """Create or modify the account on every machine in a credential YAML
+
+    Args:
+        info_dict (dict): Contains root and new account information
+        discovery_cache (dict): Discovery results keyed by IP of machine
+        modify (bool): Modify the account's password instead of creating it
+        auth (string): Redfish authentication method, "basic" or "session"
+        parallelism (int): Number of machines to work on at the same time
+        refresh_discovery (bool): Ignore the cached discovery of these machines
+
+    Returns:
+        list: IP of machine, "SUCCESS" or "FAILED", and a message describing
+        the outcome for each machine, in the order of info_dict
+    """
+    _configure_urllib3()
+    machines, cred_idx, cred_table, hints = intern_credentials(info_dict)
+    if refresh_discovery:
+        for machine in machines:
+            discovery_cache.pop(machine, None)
+
+    # Each machine is an independent, network-bound workflow, so provision them
+    # concurrently. The redfish client blocks on its sockets, which releases the
+    # GIL, so a bounded thread pool overlaps the round trips of every host.
+    with ThreadPoolExecutor(max_workers=parallelism) as executor:
+        futures = [
+            executor.submit(
+                process_machine,
+                machine,
+                cred_table[index],
+                hint,
+                modify,
+                auth,
+                discovery_cache,
+            )
+            for machine, index, hint in zip(machines, cred_idx, hints)
+        ]
+        # An unexpected error on one machine is reported as a failure of that
+        # machine alone rather than stopping the whole run.
+        results = []
+        for machine, future in zip(machines, futures):
+            try:
+                results.append(future.result())
+            except Exception as error:
+                results.append(
+                    (
+                        machine,
+                        "FAILED",
+                        f"FAILED: Unexpected error for {machine}: {error!r}",
+                    )
+                )
+        return results
+
+
+@functools.lru_cache(maxsize=None)
+def _configure_urllib3():
+    """Silence the warnings about BMCs' self-signed certificates
+
+    Only the first call does anything, so a process that provisions several
+    batches doesn't keep adding the same entry to the warnings filter list.
+    """
+    import urllib3
+
+    warnings.filterwarnings(
+        "ignore", category=urllib3.exceptions.InsecureRequestWarning
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _json_loads():
+    """Get the fastest available JSON decoder
+
+    orjson is optional; the standard library decoder is used without it.
+
+    Returns:
+        function: Decoder that accepts the raw bytes of a response body
+    """
+    try:
+        import orjson
+    except ImportError:
+        return json.loads
+    return orjson.loads
+
+
+def read_json(response):
+    """Parse the JSON body of a Redfish response
+
+    Unlike RestResponse.dict, the raw bytes are handed straight to the decoder
+    instead of being decoded to a string first.
+
+    Args:
+        response (redfish.rest.v1.RestResponse): Response to parse
+
+    Returns:
+        dict: JSON of the response, or an empty dict if it has no body
+    """
+    body = response.read
+    if not body:
+        return {}
+    return _json_loads()(body)
+
+
+def load_info(info_path, use_cache=True):
+    """Load the credential YAML file
+
+    The parsed file is kept in a JSON file next to it, which is reused for as
+    long as the YAML file's modification time and size stay the same.
+
+    Args:
+        info_path (string): path to credential YAML file
+        use_cache (bool): Read and write the JSON file next to the YAML file
+
+    Returns:
+        dict: Contains root and new account information
+    """
+    cache_path = f"{info_path}.cache.json"
+    info_stat = os.stat(info_path)
+    cache_key = [info_stat.st_mtime_ns, info_stat.st_size]
+    if use_cache:
+        try:
+            with open(cache_path, "rb") as cache_file:
+                cache = _json_loads()(cache_file.read())
+            if cache["key"] == cache_key:
+                return cache["info"]
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    import yaml
+
+    try:
+        # libyaml's C loader is much faster than PyYAML's pure-Python one
+        from yaml import CSafeLoader as SafeLoader
+    except ImportError:
+        from yaml import SafeLoader
+
+    # Both loaders detect the encoding of a binary stream themselves, which
+    # saves decoding the whole file to a string first
+    with open(info_path, "rb") as info_file:
+        info_dict = yaml.load(info_file, Loader=SafeLoader)
+    if not use_cache:
+        return info_dict
+    try:
+        # The cache holds the same credentials as the YAML file, so it must be
+        # private, which write_json_file makes sure of
+        write_json_file(cache_path, {"key": cache_key, "info": info_dict})
+    except (OSError, TypeError):
+        # Not being able to cache the file only costs speed on the next run
+        pass
+    return info_dict
+
+
+def read_stdin_documents():
+    """Read credential YAML documents from stdin as they arrive
+
+    Documents are separated by "---" lines, so a long-running supervisor can
+    keep feeding batches to one process. stdin is read a line at a time, and
+    each document is handed on as soon as the line ending it arrives rather
+    than once a whole buffer has been filled.
+
+    Returns:
+        generator: Text of each document
+    """
+    lines = []
+    for line in iter(sys.stdin.readline, ""):
+        if line.rstrip() == "---":
+            yield "".join(lines)
+            lines = []
+        else:
+            lines.append(line)
+    yield "".join(lines)
+
+
+def parse_batch(document):
+    """Parse one credential YAML document read from stdin
+
+    Args:
+        document (string): Text of the document
+
+    Returns:
+        dict: Contains root and new account information, or None if the
+        document is empty
+    """
+    import yaml
+
+    try:
+        from yaml import CSafeLoader as SafeLoader
+    except ImportError:
+        from yaml import SafeLoader
+
+    try:
+        info_dict = yaml.load(document, Loader=SafeLoader)
+    except yaml.YAMLError as error:
+        raise ValueError(f"The YAML is invalid: {error}") from error
+    if info_dict is not None and not isinstance(info_dict, dict):
+        raise ValueError("The YAML should map each machine to its subfields")
+    return info_dict
+
+
+def intern_credentials(info_dict):
+    """Split the credential YAML into machines and the credentials they use
+
+    Machines with identical credentials share a single credential tuple, so a
+    fleet that uses the same few credentials everywhere only keeps those few in
+    memory.
+
+    Args:
+        info_dict (dict): Contains root and new account information
+
+    Returns:
+        tuple: List of machines, the index into the credential table used by
+        each machine, the credential table, and the manufacturer hint of each
+        machine
+    """
+    machines = []
+    cred_idx = []
+    cred_table = []
+    hints = []
+    cred_index = {}
+    for machine, machine_info in info_dict.items():
+        if not isinstance(machine_info, dict):
+            machine_info = {}
+        missing = REQUIRED_KEYS - machine_info.keys()
+        if missing:
+            raise ValueError(
+                f"The YAML for {machine} is formatted incorrectly (missing "
+                f"{', '.join(repr(key) for key in sorted(missing))}). "
+                "Each machine should include the 'admin_user', "
+                "'admin_password', 'new_user', and 'new_password' subfields, "
+                "as shown in example.yml"
+            )
+        hint = machine_info.get("manufacturer")
+        if hint is not None:
+            # Matched the same way csv_to_yaml.py matches its manufacturer column
+            hint = str(hint).strip().casefold()
+        if hint is not None and hint not in HINTED_MANAGER_URLS:
             raise ValueError(
-                "The YAML for "
-                + machine
-                + " is formatted incorrectly. Each machine should include the "
-                + "'admin_user', 'admin_password', "
-                + "'new_user', and 'new_password' subfields, as shown in example.yml"
+                f"The 'manufacturer' subfield for {machine} must be one of "
+                f"{', '.join(repr(name) for name in HINTED_MANAGER_URLS)}"
             )
-        base_url = f"https://{machine}"
+        creds = tuple(machine_info[key] for key in CREDENTIAL_KEYS)
+        index = cred_index.get(creds)
+        if index is None:
+            index = cred_index[creds] = len(cred_table)
+            cred_table.append(creds)
+        machines.append(machine)
+        cred_idx.append(index)
+        hints.append(hint)
+    return machines, cred_idx, cred_table, hints
+
+
+def make_https_adapter():
+    """Build the connection pool for a machine's Redfish session
+
+    Every request to a machine goes through one keep-alive connection pool, so
+    the TCP and TLS handshakes are only paid once per connection rather than
+    once per request. Each client talks to a single host, so the adapter only
+    keeps one host's pool. A new adapter is built for every machine because
+    logging out of a client closes its adapter. The adapter doesn't retry
+    anything itself; with_retry is the only layer that does.
+
+    Returns:
+        requests.adapters.HTTPAdapter: Connection pool for a single machine
+    """
+    from requests.adapters import HTTPAdapter
+
+    return HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=MAX_CONCURRENT_ACCOUNT_REQUESTS,
+        pool_block=False,
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def basic_authorization(username, password):
+    """Build the HTTP Basic Authorization header for a credential
+
+    Machines sharing a credential share the header, so it is only encoded once.
+
+    Args:
+        username (string): username of the root account
+        password (string): password of the root account
+
+    Returns:
+        string: Value of the Authorization header
+    """
+    token = base64.b64encode(f"{username}:{password}".encode("utf-8")).decode("ascii")
+    return f"Basic {token}"
+
+
+def with_retry(
+    func,
+    *args,
+    attempts=RETRY_ATTEMPTS,
+    base_delay=RETRY_BASE_DELAY,
+    idempotent=True,
+    **kwargs,
+):
+    """Call a Redfish function, retrying it if it fails for a transient reason
+
+    Connection and session failures are retried after an exponentially growing,
+    jittered delay. Responses asking the client to come back later are retried
+    after the delay given in their Retry-After header. Responses rejecting the
+    credentials raise InvalidCredentialsError.
+
+    A request that isn't idempotent, like the POST creating an account, is only
+    retried if it never reached the BMC. After a timeout waiting for the answer,
+    the BMC may already have acted on it.
+
+    Args:
+        func (callable): Redfish function to call
+        attempts (int): Number of times to call func before giving up
+        base_delay (float): Delay in seconds before the first retry
+        idempotent (bool): Whether func can safely be repeated after it may
+            have reached the BMC
+
+    Returns:
+        The return value of the last call to func
+    """
+    import redfish
+
+    # Errors that may go away on their own
+    transient_errors = (
+        redfish.rest.v1.RetriesExhaustedError,
+        redfish.rest.v1.ServerDownOrUnreachableError,
+        redfish.rest.v1.SessionCreationError,
+    )
+    for attempt in range(1, attempts + 1):
+        delay = base_delay * 2 ** (attempt - 1) + random.uniform(0, 0.25)
         try:
-            redfish_obj = redfish.redfish_client(
-                base_url=base_url,
-                username=info_dict[machine]["admin_user"],
-                password=info_dict[machine]["admin_password"],
-                default_prefix="/redfish/v1",
+            response = func(*args, **kwargs)
+        except transient_errors as error:
+            if attempt == attempts or not (idempotent or failed_to_connect(error)):
+                raise
+        else:
+            status = getattr(response, "status", None)
+            if status == 401:
+                raise redfish.rest.v1.InvalidCredentialsError(
+                    "HTTP 401 Unauthorized returned: Invalid credentials supplied"
+                )
+            if attempt == attempts or status not in RETRY_STATUSES:
+                return response
+            retry_after = response.getheader("Retry-After")
+            # A Retry-After longer than MAX_RETRY_AFTER would hold the worker for
+            # too long, so the backoff delay is kept instead
+            if retry_after and retry_after.isdigit():
+                if int(retry_after) <= MAX_RETRY_AFTER:
+                    delay = int(retry_after)
+        time.sleep(delay)
+    return None
+
+
+def failed_to_connect(error):
+    """Check whether a Redfish error happened before a request reached the BMC
+
+    Args:
+        error (Exception): Error raised by the redfish client
+
+    Returns:
+        bool: True if the connection to the BMC couldn't be established
+    """
+    import urllib3
+
+    # The client raises its own errors from the requests exception, which wraps
+    # urllib3's reason for giving up
+    cause = error.__cause__
+    reason = getattr(cause.args[0], "reason", None) if cause and cause.args else None
+    return isinstance(reason, urllib3.exceptions.ConnectTimeoutError)
+
+
+def load_discovery_cache():
+    """Load the results of previous Redfish discoveries
+
+    Returns:
+        dict: Discovery results keyed by IP of machine
+    """
+    try:
+        with open(DISCOVERY_CACHE_PATH, "r", encoding="utf-8") as cache_file:
+            discovery_cache = json.load(cache_file)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(discovery_cache, dict):
+        return {}
+    # Entries that don't look like a discovery are dropped, so the machine is
+    # simply discovered again
+    return {
+        machine: discovery
+        for machine, discovery in discovery_cache.items()
+        if isinstance(discovery, dict)
+        and isinstance(discovery.get("discovered_at"), (int, float))
+    }
+
+
+def save_discovery_cache(discovery_cache):
+    """Save the results of Redfish discovery for future runs
+
+    Args:
+        discovery_cache (dict): Discovery results keyed by IP of machine
+    """
+    try:
+        os.makedirs(os.path.dirname(DISCOVERY_CACHE_PATH), exist_ok=True)
+        write_json_file(DISCOVERY_CACHE_PATH, discovery_cache)
+    except (OSError, TypeError):
+        # Not being able to cache discovery only costs speed on the next run
+        pass
+
+
+def write_json_file(path, data):
+    """Replace a cache file with JSON, atomically and readable only by its owner
+
+    The JSON is written to a temporary file next to path and moved into place,
+    so a crash or another run saving at the same time can't leave a truncated
+    file behind. The temporary file is created with mode 0600, which the moved
+    file keeps even if the file it replaces was readable by others.
+
+    Args:
+        path (string): path of the file to replace
+        data: JSON serializable data to write
+    """
+    cache_fd, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path) or ".", suffix=".tmp"
+    )
+    try:
+        with open(cache_fd, "w", encoding="utf-8") as cache_file:
+            json.dump(data, cache_file)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def process_machine(machine, creds, hint, modify, auth, discovery_cache):
+    """Create or modify the account on a single machine
+
+    Args:
+        machine (string): IP of machine
+        creds (tuple): Root and new account credentials of machine
+        hint (string): Manufacturer given in the credential YAML, if any
+        modify (bool): Modify the account's password instead of creating it
+        auth (string): Redfish authentication method, "basic" or "session"
+        discovery_cache (dict): Discovery results keyed by IP of machine
+
+    Returns:
+        tuple: IP of machine, "SUCCESS" or "FAILED", and a message describing
+        the outcome
+    """
+    import redfish
+
+    admin_user, admin_password, new_user, new_password = creds
+    base_url = f"https://{machine}"
+    try:
+        redfish_obj = with_retry(
+            redfish.redfish_client,
+            base_url=base_url,
+            username=admin_user,
+            password=admin_password,
+            default_prefix="/redfish/v1",
+            https_adapter=make_https_adapter(),
+            timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+            # Failed requests are retried, with backoff, by with_retry instead
+            max_retry=0,
+        )
+        if auth == "basic":
+            # Basic auth sends the credentials with every request, which saves
+            # creating and deleting a session when only a few requests are made.
+            # The client's login() would spend a request checking them, so the
+            # first real request does that instead.
+            redfish_obj.set_authorization_key(
+                basic_authorization(admin_user, admin_password)
+            )
+        else:
+            with_retry(redfish_obj.login, auth=auth)
+    except redfish.rest.v1.ServerDownOrUnreachableError:
+        return machine, "FAILED", f"FAILED: {machine} is down or unreachable."
+    except redfish.rest.v1.RetriesExhaustedError:
+        return machine, "FAILED", f"FAILED: Can't connect to {machine}"
+    except redfish.rest.v1.InvalidCredentialsError:
+        return machine, "FAILED", f"FAILED: Invalid Credentials for {machine}"
+    except redfish.rest.v1.SessionCreationError:
+        return (
+            machine,
+            "FAILED",
+            f"FAILED: Failed to create the session for {machine}",
+        )
+
+    try:
+        discovery = discovery_cache.get(machine)
+        if (
+            discovery is None
+            # Entries cached before vendors were recorded are rediscovered
+            or "vendor" not in discovery
+            or time.time() - discovery["discovered_at"] > DISCOVERY_CACHE_TTL
+        ):
+            if hint is not None:
+                discovery = hinted_discovery(hint)
+            else:
+                discovery = discover_machine(redfish_obj)
+            discovery_cache[machine] = discovery
+        if modify:
+            new_account = modify_accounts(
+                discovery, redfish_obj, new_user, new_password, machine
             )
-            redfish_obj.login(auth="session")
-        except redfish.rest.v1.ServerDownOrUnreachableError:
-            print(f"FAILED: {machine} is down or unreachable.")
-            continue
-        except redfish.rest.v1.RetriesExhaustedError:
-            print(f"FAILED: Can't connect to {machine}")
-            continue
-        except redfish.rest.v1.InvalidCredentialsError:
-            print(f"FAILED: Invalid Credentials for {machine}")
-            continue
-        except redfish.rest.v1.SessionCreationError:
-            print(f"FAILED: Failed to create the session for {machine}")
-            continue
-
-        system_summary = redfish_obj.get("/redfish/v1/Systems")
-        system_url = system_summary.dict["Members"][0]["@odata.id"]
-        system_json = redfish_obj.get(system_url).dict
-        if args.modify:
-            new_account = modify_accounts(system_json, redfish_obj, info_dict, machine)
         else:
             try:
-                new_account = create_accounts(system_json, redfish_obj, info_dict, machine)
+                new_account = create_accounts(
+                    discovery, redfish_obj, new_user, new_password, machine
+                )
             except KeyError as key_error:
-                print(f"FAILED: The '{info_dict[machine]['new_user']}' account "
-                f"for {machine} was NOT created due to a KeyError: {key_error}")
-                continue
-        print_response_messages(new_account, info_dict, machine)
+                # A machine that doesn't look like its cached discovery may have
+                # been replaced, so it is discovered again on the next run
+                discovery_cache.pop(machine, None)
+                return (
+                    machine,
+                    "FAILED",
+                    f"FAILED: The '{new_user}' account for {machine} "
+                    f"was NOT created due to a KeyError: {key_error}",
+                )
+        result = get_response_result(new_account, new_user, machine)
+        if result[1] == "FAILED":
+            discovery_cache.pop(machine, None)
+        return result
+    except redfish.rest.v1.InvalidCredentialsError:
+        return machine, "FAILED", f"FAILED: Invalid Credentials for {machine}"
+    except ProvisioningError as error:
+        discovery_cache.pop(machine, None)
+        return machine, "FAILED", f"FAILED: {error}"
+    # The machine stopped answering, or answered with something that can't be
+    # parsed, after logging in. Either way its discovery may no longer be right.
+    except redfish.rest.v1.ServerDownOrUnreachableError:
+        discovery_cache.pop(machine, None)
+        return machine, "FAILED", f"FAILED: {machine} is down or unreachable."
+    except redfish.rest.v1.RetriesExhaustedError:
+        discovery_cache.pop(machine, None)
+        return machine, "FAILED", f"FAILED: Can't connect to {machine}"
+    except ValueError as error:
+        discovery_cache.pop(machine, None)
+        return machine, "FAILED", f"FAILED: Unexpected response from {machine}: {error}"
+    finally:
+        close_client(redfish_obj, auth)
+
+
+def close_client(redfish_obj, auth):
+    """Log out of a machine and close the connections to it
+
+    The account has already been created or modified by the time this is
+    called, so a failed logout is ignored rather than changing the outcome.
+    The BMC expires the abandoned session by itself.
+
+    Args:
+        redfish_obj (redfish): Redfish session object
+        auth (string): Redfish authentication method, "basic" or "session"
+    """
+    import redfish
+
+    if auth == "session":
+        try:
+            redfish_obj.logout()
+            return
+        except (
+            redfish.rest.v1.BadRequestError,
+            redfish.rest.v1.RetriesExhaustedError,
+        ):
+            pass
+    # With Basic auth there is no session on the BMC, only connections to close
+    redfish_obj._session.close()
 
-        redfish_obj.logout()
 
+def discover_machine(redfish_obj):
+    """Find the system and manager of a machine and who manufactured it
 
-def modify_accounts(system_json, redfish_obj, info_dict, machine):
+    Args:
+        redfish_obj (redfish): Redfish session object
+
+    Returns:
+        dict: Basic information about machine
+    """
+    system_summary = with_retry(redfish_obj.get, SYSTEMS_URL)
+    # Only the first system's URL is needed, so don't parse the whole collection
+    # unless its members aren't laid out the usual way
+    first_member = FIRST_MEMBER_RE.search(system_summary.read)
+    if first_member is not None:
+        system_url = first_member.group(1).decode("utf-8")
+    else:
+        system_url = read_json(system_summary)["Members"][0]["@odata.id"]
+    system_json = read_json(with_retry(redfish_obj.get, system_url))
+    manager_url = None
+    if "Links" in system_json:
+        manager_url = system_json["Links"]["ManagedBy"][0]["@odata.id"]
+    elif "links" in system_json:
+        manager_url = system_json["links"]["ManagedBy"][0]["href"]
+    # iLO 5 and later put their OEM data under "Hpe" and iLO 4 under "Hp", which
+    # saves asking the manager for its firmware version. Otherwise the version
+    # is only needed for HP machines, so it is filled in on first use.
+    manufacturer = system_json["Manufacturer"]
+    oem = system_json.get("Oem", {})
+    ilo_version = None
+    if "Hpe" in oem:
+        ilo_version = 5
+    elif "Hp" in oem:
+        ilo_version = 4
+    return {
+        "system_url": system_url,
+        "manager_url": manager_url,
+        "manufacturer": manufacturer,
+        "vendor": next(
+            (vendor for vendor in VENDORS if vendor in manufacturer.casefold()),
+            "generic",
+        ),
+        "ilo_version": ilo_version,
+        "discovered_at": time.time(),
+    }
+
+
+def hinted_discovery(hint):
+    """Describe a machine from its manufacturer alone, without asking the machine
+
+    Args:
+        hint (string): Manufacturer given in the credential YAML
+
+    Returns:
+        dict: Basic information about machine
+    """
+    return {
+        "system_url": None,
+        "manager_url": HINTED_MANAGER_URLS[hint],
+        "manufacturer": hint,
+        "vendor": hint,
+        "ilo_version": None,
+        "discovered_at": time.time(),
+    }
+
+
+def modify_accounts(discovery, redfish_obj, new_user, new_password, machine):
     """Modify a pre-existing account's password
 
     Args:
-        system_json (dict): Basic information about machine
+        discovery (dict): Basic information about machine
         redfish_obj (redfish): Redfish session object
-        info_dict (dict): Contains root and new account information
+        new_user (string): username of the new account
+        new_password (string): password of the new account
         machine (string): IP of machine
 
     Returns:
         redfish.rest.v1.RestResponse: Response after attempting to modify an account.
     """
-    manufacturer = system_json["Manufacturer"]
-    if "dell" in manufacturer.lower():
-        new_account = modify_dell_account(info_dict, machine, redfish_obj)
-    else:
-        new_account = modify_generic_account(info_dict, machine, redfish_obj)
-    return new_account
+    modify_account = MODIFY_HANDLERS.get(discovery["vendor"], modify_generic_account)
+    body = {"Password": new_password}
+    return modify_account(new_user, body, machine, redfish_obj)
 
 
-def create_accounts(system_json, redfish_obj, info_dict, machine):
+def create_accounts(discovery, redfish_obj, new_user, new_password, machine):
     """Create an account
 
     Args:
-        system_json (dict): Basic information about machine
+        discovery (dict): Basic information about machine
         redfish_obj (redfish): Redfish session object
-        info_dict (dict): Contains root and new account information
+        new_user (string): username of the new account
+        new_password (string): password of the new account
         machine (string): IP of machine
 
     Returns:
         redfish.rest.v1.RestResponse: Response after attempting to create an account.
     """
-    manufacturer = system_json["Manufacturer"]
-    if "hp" in manufacturer.lower():
-        new_account = create_hp_account(info_dict, machine, system_json, redfish_obj)
-    else:
-        body = {
-            "UserName": info_dict[machine]["new_user"],
-            "Password": info_dict[machine]["new_password"],
-            "Enabled": True,
-        }
-        if "dell" in manufacturer.lower():
-            new_account = create_dell_account(redfish_obj, body)
-        else:
-            # Get name of read only role
-            roles = redfish_obj.get("/redfish/v1/AccountService/Roles")
-            try:
-                for role in roles.dict["Members"]:
-                    if "readonly" in role["@odata.id"].lower():
-                        role_id_index = role["@odata.id"].rfind("/")
-                        role_id = role["@odata.id"][role_id_index + 1 :]
-            except KeyError:
-                print(f"FAILED: Can't find roles for {machine}")
-                return None
-            body["RoleId"] = role_id
-
-            new_account = redfish_obj.post(
-                "/redfish/v1/AccountService/Accounts", body=body, timeout=20
-            )
+    create_account = CREATE_HANDLERS.get(discovery["vendor"], create_generic_account)
+    # Every vendor's body starts out the same; the handlers add to it
+    body = {"UserName": new_user, "Password": new_password}
+    return create_account(body, machine, discovery, redfish_obj)
+
+
+def create_generic_account(body, machine, discovery, redfish_obj):
+    """Create BMC account for machines that don't need manufacturer specific code
+
+    Args:
+        body (dict): Username and password of the new account
+        machine (string): IP of machine
+        discovery (dict): Basic information about machine
+        redfish_obj (redfish): Redfish session object
+
+    Returns:
+        redfish.rest.v1.RestResponse: Response after attempting to create account.
+    """
+    body["Enabled"] = True
+    # Get name of read only role
+    roles = with_retry(redfish_obj.get, ROLES_URL)
+    role_id = next(
+        (
+            role["@odata.id"].rsplit("/", 1)[-1]
+            for role in read_json(roles).get("Members", [])
+            if "readonly" in role["@odata.id"].casefold()
+        ),
+        None,
+    )
+    if role_id is None:
+        raise ProvisioningError(f"Can't find roles for {machine}")
+    body["RoleId"] = role_id
+
+    new_account = with_retry(
+        redfish_obj.post,
+        ACCOUNTS_URL,
+        body=body,
+        timeout=ACCOUNT_TIMEOUT,
+        idempotent=False,
+    )
     return new_account
 
 
-def modify_generic_account(info_dict, machine, redfish_obj):
+def modify_generic_account(new_user, body, machine, redfish_obj):
     """Modify a pre-existing account for machines that don't need manufacturer specific
     code
 
     Args:
-        info_dict (dict): Contains root and new account information
+        new_user (string): username of the new account
+        body (dict): New password of the account
         machine (string): IP of machine
         redfish_obj (redfish): Redfish session object
 
     Returns:
         redfish.rest.v1.RestResponse: Response after attempting to modify an account.
     """
-    body = {
-        "Password": info_dict[machine]["new_password"],
-    }
-    username = info_dict[machine]["new_user"]
-    user_id = get_user_id(redfish_obj, username)
-    if user_id is not None:
-        new_account = redfish_obj.patch(
-            f"/redfish/v1/AccountService/Accounts/{user_id}", body=body
-        )
-        return new_account
-
-    return None
+    user_id = get_user_id(redfish_obj, new_user)
+    new_account = with_retry(
+        redfish_obj.patch,
+        f"{ACCOUNTS_URL}/{user_id}",
+        body=body,
+    )
+    return new_account
 
 
 def get_user_id(redfish_obj, username):
@@ -181,23 +937,21 @@ def get_user_id(redfish_obj, username):
     Returns:
         string: ID of the relevant account
     """
-    users = redfish_obj.get("/redfish/v1/AccountService/Accounts")
-    for user in users.dict["Members"]:
-        user_info = redfish_obj.get(user["@odata.id"])
-        if user_info.dict["UserName"] == username:
-            return user_info.dict["Id"]
+    users = get_account_members(redfish_obj, ACCOUNTS_URL)
+    for user in users:
+        if user["UserName"] == username:
+            return user["Id"]
 
-    print("FAILED: User doesn't exist")
-    return None
+    raise ProvisioningError("User doesn't exist")
 
 
-def create_hp_account(info_dict, machine, system_json, redfish_obj):
+def create_hp_account(body, machine, discovery, redfish_obj):
     """Create BMC account for HP machines
 
     Args:
-        info_dict (dict): Contains root and new account information
+        body (dict): Username and password of the new account
         machine (string): IP of machine
-        system_json (dict): Basic information about machine
+        discovery (dict): Basic information about machine
         redfish_obj (redfish): Redfish session object
 
     Returns:
@@ -205,54 +959,47 @@ def create_hp_account(info_dict, machine, system_json, redfish_obj):
     """
     # There are differences between iLO 4 and iLO 5. Retrieve the iLO version
     # of each machine and alter the body variable accordingly
-    body = {
-        "UserName": info_dict[machine]["new_user"],
-        "Password": info_dict[machine]["new_password"],
-    }
-
-    # Assume iLO 5
-    ilo_version = 5
-    if "Links" in system_json:
-        manager_url = system_json["Links"]["ManagedBy"][0]["@odata.id"]
-    elif "links" in system_json:
-        manager_url = system_json["links"]["ManagedBy"][0]["href"]
-    if manager_url:
-        manager_json = redfish_obj.get(manager_url).dict
-        ilo_version = int(manager_json["FirmwareVersion"][4])
+    if discovery["ilo_version"] is None:
+        # Assume iLO 5
+        discovery["ilo_version"] = 5
+        if discovery["manager_url"]:
+            manager_json = read_json(
+                with_retry(redfish_obj.get, discovery["manager_url"])
+            )
+            discovery["ilo_version"] = int(manager_json["FirmwareVersion"][4])
+    ilo_version = discovery["ilo_version"]
     if ilo_version == 5 or ilo_version == 6:
         body["RoleId"] = "ReadOnly"
     else:
         body["Oem"] = {"Hp": {"Privileges": {"LoginPriv": True}}}
-        body["Oem"]["Hp"]["LoginName"] = info_dict[machine]["new_user"]
+        body["Oem"]["Hp"]["LoginName"] = body["UserName"]
 
-    new_account = redfish_obj.post("/redfish/v1/AccountService/Accounts", body=body)
+    new_account = with_retry(
+        redfish_obj.post, ACCOUNTS_URL, body=body, idempotent=False
+    )
 
     return new_account
 
 
-def modify_dell_account(info_dict, machine, redfish_obj):
+def modify_dell_account(new_user, body, machine, redfish_obj):
     """Change the password of a dell account
 
     Args:
-        info_dict (dict): Contains root and new account information
+        new_user (string): username of the new account
+        body (dict): New password of the account
         machine (string): IP of machine
         redfish_obj (redfish): Redfish session object
 
     Returns:
         redfish.rest.v1.RestResponse: Response after attempting to modify an account.
     """
-    body = {
-        "Password": info_dict[machine]["new_password"],
-    }
-    username = info_dict[machine]["new_user"]
-    user_id = get_dell_user_id(redfish_obj, username)
-    if user_id is not None:
-        new_account = redfish_obj.patch(
-            f"/redfish/v1/Managers/iDRAC.Embedded.1/Accounts/{user_id}", body=body
-        )
-        return new_account
-
-    return None
+    user_id = get_dell_user_id(redfish_obj, new_user)
+    new_account = with_retry(
+        redfish_obj.patch,
+        f"{IDRAC_ACCOUNTS_URL}/{user_id}",
+        body=body,
+    )
+    return new_account
 
 
 def get_dell_user_id(redfish_obj, username):
@@ -265,71 +1012,212 @@ def get_dell_user_id(redfish_obj, username):
     Returns:
         string: ID of the relevant dell account
     """
-    dell_accounts = redfish_obj.get("/redfish/v1/Managers/iDRAC.Embedded.1/Accounts/")
-    if "Members" in dell_accounts.dict:
-        for account in dell_accounts.dict["Members"]:
-            account_info = redfish_obj.get(account["@odata.id"])
-            if account_info.dict["UserName"] == username:
-                return account_info.dict["Id"]
+    dell_accounts = get_account_members(redfish_obj, f"{IDRAC_ACCOUNTS_URL}/")
+    for account in dell_accounts:
+        if account["UserName"] == username:
+            return account["Id"]
 
-        print(f"FAILED: User doesn't exist for {redfish_obj.get_base_url()}")
-    return None
+    raise ProvisioningError(f"User doesn't exist for {redfish_obj.get_base_url()}")
 
 
-def create_dell_account(redfish_obj, body):
+def create_dell_account(body, machine, discovery, redfish_obj):
     """Create BMC account for Dell machines
 
     Args:
+        body (dict): Username and password of the new account
+        machine (string): IP of machine
+        discovery (dict): Basic information about machine
         redfish_obj (redfish): Redfish session object
-        body (dict): Information about account for patch request
 
     Returns:
         redfish.rest.v1.RestResponse: Response after attempting to create account
     """
+    body.update(Enabled=True, RoleId="ReadOnly")
     # Go through accounts and if ID doesn't have username,
     # add account to that ID.
-    body["RoleId"] = "ReadOnly"
-    dell_accounts = redfish_obj.get("/redfish/v1/Managers/iDRAC.Embedded.1/Accounts/")
-    if "Members" in dell_accounts.dict:
-        for account in dell_accounts.dict["Members"]:
-            account_info = redfish_obj.get(account["@odata.id"])
-            account_json = account_info.dict
-            if not account_json["UserName"] and account_json["Id"] != "1":
-                available_id = account_json["Id"]
-                break
-        new_account = redfish_obj.patch(
-            f"/redfish/v1/Managers/iDRAC.Embedded.1/Accounts/{available_id}",
-            body=body,
-            timeout=20,
-        )
+    dell_accounts = get_account_members(redfish_obj, f"{IDRAC_ACCOUNTS_URL}/")
+    available_id = next(
+        (
+            account_json["Id"]
+            for account_json in dell_accounts
+            if not account_json["UserName"] and account_json["Id"] != "1"
+        ),
+        None,
+    )
+    if available_id is None:
+        raise ProvisioningError(f"No free account slot on {machine}")
+    new_account = with_retry(
+        redfish_obj.patch,
+        f"{IDRAC_ACCOUNTS_URL}/{available_id}",
+        body=body,
+        timeout=ACCOUNT_TIMEOUT,
+    )
     return new_account
 
 
-def print_response_messages(new_account, info_dict, machine):
-    """Print the response messages after attempting to create read only accounts
+def get_account_members(redfish_obj, accounts_url):
+    """Get the contents of every account in an account collection
+
+    The collection is requested with $expand so that every account comes back
+    in a single response. If the BMC doesn't honor $expand, the accounts are
+    fetched concurrently, a batch at a time, and no further batches are fetched
+    once the caller stops iterating. A BMC whose service root lists its protocol
+    features without $expand support isn't asked to expand the collection at
+    all.
+
+    Args:
+        redfish_obj (redfish): Redfish session object
+        accounts_url (string): URL of the account collection
+
+    Returns:
+        generator: JSON of each account in the collection, in collection order
+    """
+    features = get_path(redfish_obj.root, "ProtocolFeaturesSupported")
+    if features is None or get_path(features, "ExpandQuery", "Levels"):
+        accounts = with_retry(
+            redfish_obj.get, accounts_url, args={"$expand": ".($levels=1)"}
+        )
+        if accounts.status != 200:
+            accounts = with_retry(redfish_obj.get, accounts_url)
+    else:
+        accounts = with_retry(redfish_obj.get, accounts_url)
+    members = read_json(accounts).get("Members", [])
+    if all("UserName" in member for member in members):
+        yield from members
+        return
+
+    urls = [member["@odata.id"] for member in members]
+    for start in range(0, len(urls), MAX_CONCURRENT_ACCOUNT_REQUESTS):
+        batch = urls[start : start + MAX_CONCURRENT_ACCOUNT_REQUESTS]
+        # Each batch is fetched completely before anything is yielded, so a
+        # caller that stops iterating doesn't leave threads or requests behind
+        with ThreadPoolExecutor(max_workers=len(batch)) as executor:
+            responses = list(
+                executor.map(functools.partial(with_retry, redfish_obj.get), batch)
+            )
+        for response in responses:
+            yield read_json(response)
+
+
+def get_response_result(new_account, new_user, machine):
+    """Describe the outcome of attempting to create or modify a read only account
 
     Args:
         new_account (redfish.rest.v1.RestResponse): Response of account creation
-        info_dict (dict): Contains root and new account information
+        new_user (string): username of the new account
         machine (string): IP of machine
+
+    Returns:
+        tuple: IP of machine, "SUCCESS" or "FAILED", and a message describing
+        the outcome
     """
-    if new_account is not None:
-        error_messages = redfish.messages.get_error_messages(new_account)
-        if (
-            error_messages
-            and "The request completed successfully." not in error_messages
+    if new_account.status >= 400 or not reports_success(new_account):
+        error_messages = get_error_messages(new_account)
+        return (
+            machine,
+            "FAILED",
+            f"FAILED: The '{new_user}' account "
+            f"for {machine} was NOT created due to an error: {error_messages}",
+        )
+    return (
+        machine,
+        "SUCCESS",
+        f"The '{new_user}' account for "
+        f"{machine} was created and/or modified successfully.",
+    )
+
+
+def reports_success(response):
+    """Check whether the body of a successful response agrees that it succeeded
+
+    Some BMCs, like iLO, wrap the messages of a successful request in an "error"
+    object. Such a response only counts as a success if every message in it
+    does.
+
+    Args:
+        response (redfish.rest.v1.RestResponse): Response with a 2xx status
+
+    Returns:
+        bool: False if the body reports an error
+    """
+    try:
+        error = get_path(read_json(response), "error")
+    except ValueError:
+        # A body that isn't JSON can't report an error either
+        return True
+    if error is None:
+        return True
+    messages = get_path(error, "@Message.ExtendedInfo") or []
+    return bool(messages) and all(
+        str(get_path(message, "MessageId")).rsplit(".", 1)[-1] in SUCCESS_MESSAGES
+        for message in messages
+    )
+
+
+def get_error_messages(response):
+    """Build a string out of the messages in a Redfish response
+
+    Args:
+        response (redfish.rest.v1.RestResponse): Response to get the messages of
+
+    Returns:
+        string: One line per message in the response
+    """
+    try:
+        response_json = read_json(response)
+    except ValueError:
+        # Both json's and orjson's decoding errors are ValueErrors
+        response_json = {}
+    messages = get_path(response_json, "@Message.ExtendedInfo")
+    if messages is None:
+        messages = get_path(response_json, "error", "@Message.ExtendedInfo")
+    if messages is None:
+        # Fall back to the error's own code and message
+        error_id = get_path(response_json, "error", "code")
+        error_message = get_path(response_json, "error", "message")
+        if error_id is None and error_message is None:
+            return f"\nHTTP {response.status}\n"
+        messages = [{"MessageId": error_id, "Message": error_message}]
+
+    lines = []
+    for message in messages:
+        message_id = get_path(message, "MessageId") or ""
+        message_text = get_path(message, "Message")
+        lines.append(f"{message_id}: {message_text}" if message_text else message_id)
+    # Surrounded by blank lines so the messages start on a line of their own
+    return "\n".join(["", *lines, ""])
+
+
+def get_path(data, *keys):
+    """Follow a chain of keys and indexes into parsed JSON
+
+    Args:
+        data (dict): Parsed JSON
+        keys: Keys and indexes to follow, outermost first
+
+    Returns:
+        The value at the end of the chain, or None if any part of it is missing
+    """
+    # Error responses are often missing parts of the chain, so check each step
+    # instead of catching the exceptions of failed lookups
+    for key in keys:
+        if isinstance(data, dict):
+            data = data.get(key)
+        elif (
+            isinstance(data, list)
+            and isinstance(key, int)
+            and -len(data) <= key < len(data)
         ):
-            print(
-                f"FAILED: The '{info_dict[machine]['new_user']}' account "
-                f"for {machine} was NOT created due to an error: {error_messages}"
-            )
+            data = data[key]
         else:
-            print(
-                (
-                    f"The '{info_dict[machine]['new_user']}' account for "
-                    f"{machine} was created and/or modified successfully."
-                )
-            )
+            return None
+    return data
+
+
+# Manufacturer specific account handlers, keyed by vendor. Vendors without a
+# handler are handled generically.
+CREATE_HANDLERS = {"hp": create_hp_account, "dell": create_dell_account}
+MODIFY_HANDLERS = {"dell": modify_dell_account}
 
 
 # Executes main if run as a script.